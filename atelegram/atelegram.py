@@ -7,18 +7,21 @@ through async.Queue
 
 '''
 
+import os
 import json
 import asyncio
 import async_timeout
 import sys
 import yaml
+from collections import OrderedDict
 from arequests.arequests import (Arequests, SomeClientError,
                                  SomeServerError, AuthorizationError)
 from .atelegram_log import logger
 from .tg_bot import Bot
+from .tg_dedup import Dedup
 from .tg_message import Msg
 
-__version__ = '0.0.6'
+__version__ = '0.0.9'
 print(f'Imported Telegram from telegram.py v{__version__}')
 
 # read yaml file with configuration data
@@ -27,14 +30,21 @@ with open("atelegram/atelegram.yml", 'r') as stream:
 
 class Atelegram(Arequests):
     '''functions for receiving and sending telegrams'''
-    def __init__(self, config, max_connections=None):
+    def __init__(self, config, max_connections=None, config_file=None):
         if not config:
             raise ValueError('missing config data')
         self.cfg = config
+        self.config_file = config_file
         self.bots = dict()
         self.in_msgs = None
         self.out_msgs = None
         self.task_out_msgs = None
+        self.task_watch_config = None
+        self.task_flush_in_msgs = None
+        self.dedup = Dedup(window=config.get('in_msgs_dedup_window', 60),
+                           maxlen=config.get('in_msgs_dedup_maxlen', 10000))
+        self.pending_msgs = OrderedDict()
+        self.pending_event = None
         super().__init__(max_connections=max_connections)
         logger.debug('Telegram initialised')
 
@@ -65,43 +75,217 @@ class Atelegram(Arequests):
 
     async def _initialise_bots(self):
         '''getMe data to update bots and check validity'''
-        for bot_name in self.cfg['bots'].keys():
-            self.bots[bot_name] = Bot(self.cfg['bots'][bot_name],
-                                      self.cfg['telegram_url'])
-            print(f'{bot_name} initialised')
-            try:
-                response = await self.agetMe(bot_name=bot_name)
-                assert response, 'not ok'
-                assert response.is_bot, 'is not a bot'
-                old_msgs = await self.agetUpdates(offset=0, bot_name=bot_name)
-                del old_msgs
-            except AssertionError as err:
-                logger.error(f'{bot_name}: {err}', exc_info=False)
-                del self.bots[bot_name]
-            else:
-                logger.info(response)
-                self.bots[bot_name].__dict__.update(response.__dict__)
+        bots = self.cfg['bots']
+        await asyncio.gather(*(self._initialise_bot(bot_name, bots[bot_name])
+                               for bot_name in bots))
         del self.cfg['bots']
 
+    async def _initialise_bot(self, bot_name, data) -> bool:
+        '''getMe data for single bot, drain old msgs and register bot
+        bot is only registered after it is validated
+        returns False if bot is not valid or bot_name is taken meanwhile'''
+        try:
+            bot = Bot(dict(data, bot_name=bot_name), self.cfg['telegram_url'])
+            print(f'{bot_name} initialised')
+            response = await self.agetMe(bot_name=bot_name, bot=bot)
+            assert response, 'not ok'
+            assert response.is_bot, 'is not a bot'
+            old_msgs = await self.agetUpdates(offset=0, bot_name=bot_name,
+                                              bot=bot)
+            del old_msgs
+            assert bot_name not in self.bots, 'bot added meanwhile'
+        except AssertionError as err:
+            logger.error(f'{bot_name}: {err}', exc_info=False)
+            return False
+        logger.info(response)
+        bot.__dict__.update(response.__dict__)
+        self.bots[bot_name] = bot
+        return True
+
     async def _initialise_msgs_loops(self):
         '''loop polling all active telegram bots and put msgs on queue'''
+        self.in_msgs = asyncio.Queue()
+        self.out_msgs = asyncio.Queue()
+        self.pending_event = asyncio.Event()
+        self.task_flush_in_msgs = asyncio.create_task(
+            self._loop_flush_in_msgs())
         for bot_name in self.bots:
-            self.bots[bot_name].task = asyncio.create_task(
-                self._loop_in_msgs(bot_name=bot_name))
+            self._start_loop_in_msgs(bot_name)
         self.task_out_msgs = asyncio.create_task(self._loop_out_msgs())
+        if self.config_file:
+            self.task_watch_config = asyncio.create_task(
+                self._loop_watch_config(self.config_file))
+
+    def _start_loop_in_msgs(self, bot_name):
+        '''start polling task of single bot'''
+        self.bots[bot_name].task = asyncio.create_task(
+            self._loop_in_msgs(bot_name=bot_name))
+
+    async def _stop_loop_in_msgs(self, bot_name):
+        '''stop polling task of single bot, other bots keep running'''
+        task = getattr(self.bots[bot_name], 'task', None)
+        if task is None:
+            return
+        task.cancel()
+        # asyncio.wait does not raise the CancelledError of task
+        done, pending = await asyncio.wait({task}, timeout=0.5)
+        if pending:
+            logger.error(f'{bot_name}: polling task not stopped in time')
+        self.bots[bot_name].task = None
 
     async def _shutdown_loop_in_msgs(self):
-        '''shutdonw _loop_in_msgs for all bot_name'''
-        tasks = {self.bots[bot_name].task for bot_name in self.bots}
-        tasks.add(self.task_out_msgs)
-        for i, task in enumerate(tasks):
+        '''shutdonw _loop_in_msgs for all bot_name
+        producers (config watcher, polling) are stopped before consumers'''
+        await self._cancel_tasks({self.task_watch_config})
+        await self._cancel_tasks({getattr(self.bots[bot_name], 'task', None)
+                                  for bot_name in self.bots})
+        await self._cancel_tasks({self.task_flush_in_msgs,
+                                  self.task_out_msgs})
+        # msgs re-queued while _loop_out_msgs was stopping
+        self._drop_out_msgs(err=RuntimeError('Atelegram shut down'))
+
+    @staticmethod
+    async def _cancel_tasks(tasks):
+        '''cancel all tasks and wait until they are finished'''
+        tasks = [task for task in tasks if task is not None]
+        for task in tasks:
             task.cancel()
+        try:
             async with async_timeout.timeout(0.5):
-                await task
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.TimeoutError:
+            logger.error(f'tasks not stopped in time: {tasks}')
+
+    def _drop_out_msgs(self, bot_name=None, err=None):
+        '''remove queued out msgs of bot_name (all if None) from out_msgs
+        and fail their delivery futures with err'''
+        if self.out_msgs is None:
+            return
+        keep = list()
+        while not self.out_msgs.empty():
+            msg = self.out_msgs.get_nowait()
+            if bot_name is None or getattr(msg, 'bot_name', None) == bot_name:
+                logger.error(f'msg:{msg!r} dropped: {err}', exc_info=False)
+                self._resolve_sent_future(msg, err=err)
+            else:
+                keep.append(msg)
+        for msg in keep:
+            self.out_msgs.put_nowait(msg)
+
+    async def add_bot(self, bot_name, data) -> bool:
+        '''register new bot at runtime and start polling it
+        data: dict like cfg['bots'][bot_name], token is required
+        returns False if bot_name exists already or bot is not valid'''
+        if bot_name in self.bots:
+            logger.error(f'{bot_name}: bot exists already')
+            return False
+        if not await self._initialise_bot(bot_name, data):
+            return False
+        if self.in_msgs is not None:
+            self._start_loop_in_msgs(bot_name)
+        logger.info(f'{bot_name}: bot added')
+        return True
+
+    async def remove_bot(self, bot_name) -> bool:
+        '''stop polling bot and remove it at runtime'''
+        if bot_name not in self.bots:
+            logger.error(f'{bot_name}: bot unknown')
+            return False
+        await self._stop_loop_in_msgs(bot_name)
+        del self.bots[bot_name]
+        self._drop_out_msgs(bot_name, err=KeyError(f'{bot_name}: removed'))
+        logger.info(f'{bot_name}: bot removed')
+        return True
+
+    async def update_token(self, bot_name, token) -> bool:
+        '''replace token of running bot without restarting its polling task
+        old token is kept if new token is not valid'''
+        if bot_name not in self.bots:
+            logger.error(f'{bot_name}: bot unknown')
+            return False
+        bot = self.bots[bot_name]
+        try:
+            # validate with temporary bot, polling keeps using old token
+            new_bot = Bot(dict(token=token, bot_name=bot_name),
+                          self.cfg['telegram_url'])
+            response = await self._aget_method(method='getMe', bot=new_bot)
+            assert response['ok'], 'not ok'
+            response = Msg(response['result'], bot_name=bot_name)
+            assert getattr(response, 'is_bot', False), 'is not a bot'
+            assert self.bots.get(bot_name) is bot, 'bot removed meanwhile'
+        except AssertionError as err:
+            logger.error(f'{bot_name}: new token not valid, old token kept:'
+                         f' {err}', exc_info=False)
+            return False
+        if response.id != bot.id:
+            # token of another bot: update_ids of old bot are meaningless
+            restart = getattr(bot, 'task', None) is not None
+            await self._stop_loop_in_msgs(bot_name)
+            try:
+                bot.token = token
+                bot.last_update_id = 0
+                await self.agetUpdates(offset=0, bot_name=bot_name, bot=bot)
+            finally:
+                # no restart if bot was removed meanwhile
+                if restart and self.bots.get(bot_name) is bot:
+                    self._start_loop_in_msgs(bot_name)
+        else:
+            bot.token = token
+        bot.__dict__.update(response.__dict__)
+        if self.bots.get(bot_name) is not bot:
+            logger.error(f'{bot_name}: bot removed while token was updated')
+            return False
+        logger.info(f'{bot_name}: token updated')
+        return True
+
+    async def reload_bots(self, bots):
+        '''add, remove and update bots to match bots (dict like cfg['bots'])
+        unchanged bots are not touched'''
+        tasks = [self.remove_bot(bot_name) for bot_name in list(self.bots)
+                 if bot_name not in bots]
+        for bot_name, data in bots.items():
+            if bot_name not in self.bots:
+                tasks.append(self.add_bot(bot_name, data))
+            elif data.get('token') != self.bots[bot_name].token:
+                tasks.append(self.update_token(bot_name, data.get('token')))
+        await asyncio.gather(*tasks)
+
+    async def _loop_watch_config(self, filename):
+        '''reload bots from yaml file whenever the file is modified'''
+        error = None  # last error, logged only once
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError as err:
+            logger.error(f'{filename}: {err}', exc_info=False)
+            mtime, error = None, str(err)
+        while True:
+            try:
+                await asyncio.sleep(
+                    self.cfg.get('config_reload_interval', 0.2))
+                new_mtime = os.stat(filename).st_mtime
+                if new_mtime == mtime:
+                    continue
+                with open(filename, 'r') as stream:
+                    config = yaml.safe_load(stream)
+                mtime, error = new_mtime, None
+                bots = config.get('bots') if isinstance(config, dict) else None
+                if not isinstance(bots, dict):
+                    # missing bots or file read while being saved
+                    logger.error(f'{filename}: no bots, reload skipped')
+                    continue
+                logger.info(f'{filename} modified, reload bots')
+                await self.reload_bots(bots)
+            except asyncio.CancelledError:
+                logger.info('_loop_watch_config cancelled')
+                break
+            except Exception as err:
+                if str(err) != error:
+                    logger.error(f'{filename}: {err}',
+                                 exc_info=not isinstance(err, OSError))
+                error = str(err)
 
     async def _loop_in_msgs(self, bot_name=None):
         '''loop to collect tg messages from single bot'''
-        self.in_msgs = asyncio.Queue()
         while True:
             try:
                 msgs = await self.aget_new_Updates(bot_name=bot_name)
@@ -114,14 +298,76 @@ class Atelegram(Arequests):
                 await self.in_msgs.put(msg)
             else:
                 for msg in msgs:
-                    await self.in_msgs.put(msg)
+                    await self._put_in_msg(msg)
                     ftext = f'in -> {self.in_msgs.qsize()}. {msg.bot_name!r}'
 #                    logger.info(f'{ftext} : {msg.message!r}')
             await asyncio.sleep(self.cfg['wait_between_msgs_looping'])
 
+    @staticmethod
+    def _msg_key(msg):
+        '''returns (bot_name, chat_id, message_id) of msg'''
+        message = msg.message
+        chat_id = getattr(getattr(message, 'chat', None), 'id', None)
+        return (msg.bot_name, chat_id, getattr(message, 'message_id', None))
+
+    async def _put_in_msg(self, msg):
+        '''drop duplicate updates, deliver new msgs at once and hold
+        edits for coalescing into the latest version'''
+        if self.dedup.seen((msg.bot_name, msg.update_id)):
+            logger.debug(f'duplicate update dropped: {msg!r}')
+            return
+        window = self.cfg.get('in_msgs_coalesce_window', 0.3)
+        key = self._msg_key(msg)
+        if window <= 0 or not hasattr(msg.message, 'edit_date'):
+            await self._deliver_in_msg(key, msg)
+            return
+        if key in self.pending_msgs:
+            deadline, pending = self.pending_msgs[key]
+            # update_id orders edits, edit_date has only 1 s resolution
+            if msg.update_id > pending.update_id:
+                self.pending_msgs[key] = (deadline, msg)
+            logger.debug(f'edit coalesced: {msg!r}')
+            return
+        deadline = asyncio.get_running_loop().time() + window
+        self.pending_msgs[key] = (deadline, msg)
+        self.pending_event.set()
+
+    async def _deliver_in_msg(self, key, msg):
+        '''put msg on in_msgs unless a later update of it was delivered'''
+        if not self.dedup.newer(key, msg.update_id):
+            logger.debug(f'outdated message dropped: {msg!r}')
+            return
+        await self.in_msgs.put(msg)
+
+    async def _loop_flush_in_msgs(self):
+        '''deliver held msgs when their coalescing window has passed'''
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if not self.pending_msgs:
+                    self.pending_event.clear()
+                    await self.pending_event.wait()
+                    continue
+                key, (deadline, msg) = next(iter(self.pending_msgs.items()))
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                del self.pending_msgs[key]
+                await self._deliver_in_msg(key, msg)
+            except asyncio.CancelledError:
+                # hand over held msgs instead of dropping them
+                for key, (deadline, msg) in self.pending_msgs.items():
+                    if self.dedup.newer(key, msg.update_id):
+                        self.in_msgs.put_nowait(msg)
+                self.pending_msgs.clear()
+                logger.info('_loop_flush_in_msgs cancelled')
+                break
+            except Exception as err:
+                logger.error(f'_loop_flush_in_msgs: {err}', exc_info=True)
+
     async def _loop_out_msgs(self):
         '''send whatever msg in queue to destination bot'''
-        self.out_msgs = asyncio.Queue()
         while True:
             try:
                 msg = await self.out_msgs.get()
@@ -129,26 +375,53 @@ class Atelegram(Arequests):
                 ftext = 'ERROR: missing out_text in msg'
                 text = msg.out_text if hasattr(msg, 'out_text') else ftext
                 bot_name = msg.bot_name
+                if bot_name not in self.bots:
+                    raise KeyError(f'{bot_name}: bot unknown')
                 chat_id = msg.message.from_.id
 #                reply_to_message_id = msg.message.message_id
                 msg_sent = await self.asend_message(text, bot_name, chat_id)
                 logger.debug(msg_sent)
                 logger.debug(msg)
-                assert msg_sent, msg
+                # _aget_method returns ok=False after all trials failed
+                assert msg_sent and msg_sent.get('ok'), msg
+                self._resolve_sent_future(msg, reply=msg_sent)
             except AssertionError:
+                if msg.bot_name not in self.bots:
+                    # bot removed while msg was sent
+                    err = KeyError(f'{msg.bot_name}: bot unknown')
+                    logger.error(f'msg:{msg!r} dropped: {err}')
+                    self._resolve_sent_future(msg, err=err)
+                    continue
                 logger.error(f'msg:{msg!r} was not sent', exc_info=False)
                 await self.out_msgs.put(msg)
                 await asyncio.sleep(self.cfg['wait_out_msgs_not_sent'])
+            except KeyError as err:
+                logger.error(f'msg:{msg!r} dropped: {err}', exc_info=False)
+                self._resolve_sent_future(msg, err=err)
             except AttributeError as err:
                 logger.error(f'msg:{msg} incomplete,\n    was not sent: {err}',
                              exc_info=False)
+                self._resolve_sent_future(msg, err=err)
             except asyncio.CancelledError:
                 logger.error('_loop_out_msgs cancelled')
+                self._drop_out_msgs(err=RuntimeError('Atelegram shut down'))
                 break
             except Exception as err:
                 logger.error(f'msg:{msg} not sent: {err}', exc_info=True)
+                self._resolve_sent_future(msg, err=err)
             await asyncio.sleep(self.cfg['wait_between_msgs_looping'])
 
+    @staticmethod
+    def _resolve_sent_future(msg, reply=None, err=None):
+        '''set result of delivery future attached by tg_bridge.Bridge'''
+        future = msg.__dict__.pop('sent_future', None)
+        if future is None or future.done():
+            return
+        if err is None:
+            future.set_result(reply)
+        else:
+            future.set_exception(err)
+
     async def _aget_method(self, method='method', bot=None, params=None,
                            maxtrials=None, readtimeout=None) -> dict():
         '''
@@ -183,10 +456,11 @@ class Atelegram(Arequests):
         logger.error('ERROR: failed to get data')
         return dict(ok=False, result=list())
 
-    async def agetMe(self, bot_name=None):
-        '''returns basic information about chat '''
-        response = await self._aget_method(method='getMe',
-                                           bot=self.bots[bot_name])
+    async def agetMe(self, bot_name=None, bot=None):
+        '''returns basic information about chat
+        bot: Bot not yet registered in bots, default self.bots[bot_name]'''
+        bot = self.bots[bot_name] if bot is None else bot
+        response = await self._aget_method(method='getMe', bot=bot)
         if response['ok']:
             return Msg(response['result'], bot_name=bot_name)
         logger.error(response)
@@ -200,11 +474,12 @@ class Atelegram(Arequests):
                                       readtimeout=readtimeout)
 
     async def agetUpdates(self, offset='onlyNewMsgs', bot_name=None,
-                          maxtrials=None, readtimeout=None) -> list:
+                          maxtrials=None, readtimeout=None, bot=None) -> list:
         '''offset:
                 default -> get all new messages
                 0       -> get all messages
-                -n      -> get last n messages'''
+                -n      -> get last n messages
+        bot: Bot not yet registered in bots, default self.bots[bot_name]'''
         async def emsg(msg):
             '''replace attribute edited_message with message'''
             if hasattr(msg, 'message'):
@@ -213,12 +488,13 @@ class Atelegram(Arequests):
             del msg.edited_message
             return msg
 
+        bot = self.bots[bot_name] if bot is None else bot
         if offset == 'onlyNewMsgs':
-            offset = self.bots[bot_name].last_update_id + 1
+            offset = bot.last_update_id + 1
         params = {'offset': offset,
                   'allowed_updates': ['message', 'edited_message']}
         responses = await self._aget_method(method='getUpdates',
-                                            bot=self.bots[bot_name],
+                                            bot=bot,
                                             params=params,
                                             maxtrials=maxtrials,
                                             readtimeout=readtimeout)
@@ -227,7 +503,7 @@ class Atelegram(Arequests):
                 logger.info(result)
             msgs = [await emsg(Msg(result, bot_name=bot_name)) for result
                     in responses['result']]
-            self.bots[bot_name].last_update_id = msgs[-1].update_id
+            bot.last_update_id = msgs[-1].update_id
             return msgs
         return []
 
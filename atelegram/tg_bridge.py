@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''
+Classes to put outbound msgs on Atelegram.out_msgs from other threads
+and processes
+
+Bridge          submit() from any thread, batched into the event loop
+ProcessChannel  bounded pipe for worker processes, read by a Bridge
+
+'''
+import queue
+import functools
+import asyncio
+import threading
+import multiprocessing
+import concurrent.futures
+from .atelegram_log import logger
+
+__version__ = '0.0.3'
+
+print(f'Loading tg_bridge.py v{__version__}')
+
+class Bridge(object):
+    '''thread-safe producer bridge into Atelegram.out_msgs
+    must be created on the event loop running Atelegram
+    submit() blocks while maxsize msgs are not yet sent (backpressure)'''
+    def __init__(self, tg, maxsize=None, loop=None):
+        self.tg = tg
+        self.loop = asyncio.get_running_loop() if loop is None else loop
+        maxsize = (tg.cfg.get('bridge_maxsize', 10000) if
+                   maxsize is None else maxsize)
+        self.maxsize = maxsize
+        self._unsent = 0  # submitted msgs with future not done
+        self._lock = threading.Lock()
+        self._free = threading.Condition(self._lock)
+        self._batch = list()
+        self._threads = list()
+        self._no_future = _NoFuture(self)
+        logger.debug('Bridge initialised')
+
+    def submit(self, msg, future=True):
+        '''put msg on out_msgs, returns future with reply when sent
+        future=False: no future (None), failures are only logged
+        do not call from the event loop thread, use out_msgs.put there'''
+        if future:
+            return self.submit_many([msg])[0]
+        self.submit_many([msg], futures=False)
+        return None
+
+    def submit_many(self, msgs, futures=True) -> list:
+        '''put msgs on out_msgs with a single wake-up of the event loop
+        returns list of futures, empty list if futures=False'''
+        result = list()
+        msgs = list(msgs)
+        while msgs:
+            # reserve slots for as many msgs as possible in one go
+            with self._free:
+                while self._unsent >= self.maxsize:
+                    self._free.wait()
+                n = min(len(msgs), self.maxsize - self._unsent)
+                self._unsent += n
+            if futures:
+                items = [(msg, self._new_future()) for msg in msgs[:n]]
+                result.extend(future for msg, future in items)
+            else:
+                items = [(msg, None) for msg in msgs[:n]]
+            msgs = msgs[n:]
+            self._publish(items)
+        return result
+
+    def _new_future(self):
+        '''delivery future, frees its slot when done'''
+        future = concurrent.futures.Future()
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future=None):
+        '''free slot of a done future'''
+        with self._free:
+            self._unsent -= 1
+            # wake blocked producers at half full, not for every slot
+            if self._unsent == self.maxsize // 2:
+                self._free.notify_all()
+
+    def _publish(self, items):
+        '''append items to batch, wake event loop if batch was empty'''
+        if not items:
+            return
+        with self._lock:
+            wake = not self._batch
+            self._batch.extend(items)
+        if wake:
+            try:
+                self.loop.call_soon_threadsafe(self._drain)
+            except RuntimeError as err:
+                # event loop closed: _drain never runs, release slots
+                with self._lock:
+                    batch, self._batch = self._batch, list()
+                for msg, future in batch:
+                    (future or self._no_future).set_exception(err)
+                raise
+
+    def _drain(self):
+        '''move pending batch to out_msgs, runs in event loop'''
+        with self._lock:
+            batch, self._batch = self._batch, list()
+        task = self.tg.task_out_msgs
+        for msg, future in batch:
+            if future is None:
+                future = self._no_future
+            elif not future.set_running_or_notify_cancel():
+                continue
+            if task is None or task.done():
+                future.set_exception(RuntimeError('Atelegram not running'))
+                continue
+            msg.sent_future = future
+            self.tg.out_msgs.put_nowait(msg)
+
+    def attach(self, channel) -> threading.Thread:
+        '''forward msgs of ProcessChannel to out_msgs in a reader thread'''
+        thread = threading.Thread(target=self._read_channel, args=(channel,),
+                                  name='Bridge-reader', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def _read_channel(self, channel):
+        '''read batches from channel until closed'''
+        while True:
+            items = channel.get_batch()
+            if items is None:
+                break
+            try:
+                futures = self.submit_many([msg for msg, tag in items])
+            except RuntimeError as err:
+                # event loop closed
+                logger.error(f'Bridge reader stopped: {err}', exc_info=False)
+                break
+            for (msg, tag), future in zip(items, futures):
+                future.add_done_callback(
+                    functools.partial(channel.put_result, tag))
+        logger.debug('Bridge reader finished')
+
+    def __repr__(self):
+        return f'Bridge(unsent={self._unsent}, maxsize={self.maxsize}, ' + \
+               f'readers={len(self._threads)})'
+
+
+class _NoFuture(object):
+    '''shared stand-in for the delivery future of msgs submitted with
+    future=False, frees the slot of each msg when sent or dropped'''
+    def __init__(self, bridge):
+        self._bridge = bridge
+
+    def done(self):
+        return False
+
+    def set_result(self, result):
+        self._bridge._release()
+
+    def set_exception(self, err):
+        logger.error(f'msg submitted without future not sent: {err}')
+        self._bridge._release()
+
+
+class ProcessChannel(object):
+    '''bounded pipe from worker processes to a Bridge
+    put() blocks while the channel is full (backpressure)
+    results=True: (tag, ok, error) of every msg is sent back to results,
+    use one channel per worker process waiting for its results'''
+    def __init__(self, maxsize=1000, batchsize=100, results=False):
+        self.batchsize = batchsize
+        self._queue = multiprocessing.Queue(maxsize)
+        self.results = multiprocessing.Queue() if results else None
+        self._closed = False
+
+    def put(self, msg, tag=None):
+        '''send msg to Atelegram, called in worker process
+        tag identifies msg in results'''
+        self._queue.put((msg, tag))
+
+    def get_result(self, timeout=None):
+        '''returns (tag, ok, error) of next sent or failed msg,
+        called in worker process'''
+        return self.results.get(timeout=timeout)
+
+    def put_result(self, tag, future):
+        '''log failed msg and report its result, done callback of future'''
+        err = (concurrent.futures.CancelledError() if future.cancelled()
+               else future.exception())
+        if err is not None:
+            logger.error(f'msg {tag!r} from process not sent: {err}')
+        if self.results is not None:
+            self.results.put((tag, err is None,
+                              None if err is None else repr(err)))
+
+    def close(self):
+        '''stop reader thread of attached Bridge'''
+        self._queue.put(None)
+
+    def get_batch(self):
+        '''returns list of up to batchsize (msg, tag), None if closed'''
+        item = None if self._closed else self._queue.get()
+        if item is None:
+            return None
+        items = [item]
+        while len(items) < self.batchsize:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # deliver this batch, stop on next call
+                self._closed = True
+                break
+            items.append(item)
+        return items
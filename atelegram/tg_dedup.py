@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+'''
+Class for bounded, time windowed index of already seen keys
+used to drop duplicate and outdated telegram updates
+'''
+import time
+from collections import OrderedDict
+
+__version__ = '0.0.2'
+
+print(f'Loading tg_dedup.py v{__version__}')
+
+class Dedup(object):
+    '''remembers keys (with value) for window seconds, at most maxlen keys'''
+    def __init__(self, window=60, maxlen=10000):
+        self.window = window
+        self.maxlen = maxlen
+        self._seen = OrderedDict()
+
+    def _purge(self, now):
+        '''forget keys older than window'''
+        while self._seen and next(iter(self._seen.values()))[0] < now:
+            self._seen.popitem(last=False)
+
+    def seen(self, key) -> bool:
+        '''returns True if key was seen within window, else records key'''
+        return not self.newer(key)
+
+    def newer(self, key, value=None) -> bool:
+        '''returns False if key was recorded within window with a value
+        >= value (any value if value is None), else records value for key'''
+        now = time.monotonic()
+        self._purge(now)
+        if key in self._seen:
+            old = self._seen[key][1]
+            if value is None or old is not None and old >= value:
+                return False
+            del self._seen[key]  # keep keys ordered by expiry
+        self._seen[key] = (now + self.window, value)
+        if len(self._seen) > self.maxlen:
+            self._seen.popitem(last=False)
+        return True
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __repr__(self):
+        return f'Dedup(window={self.window}, maxlen={self.maxlen}, ' + \
+               f'keys={len(self)})'
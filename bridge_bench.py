@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput check for atelegram.tg_bridge
+
+compares enqueue rate of a single coroutine on the event loop with
+8 threads using Bridge.submit() with and without delivery futures and
+runs a ProcessChannel round trip with results sent back to the worker
+a stand-in for Atelegram consumes out_msgs, no telegram access needed
+
+python bridge_bench.py [number of msgs]
+"""
+import sys
+import time
+import asyncio
+import threading
+import multiprocessing
+import concurrent.futures
+from atelegram.tg_bridge import Bridge, ProcessChannel
+from atelegram.tg_message import Msg
+
+__version__ = '0.0.2'
+
+N_THREADS = 8
+
+
+class FakeTelegram():
+    '''provides out_msgs and resolves delivery futures like Atelegram'''
+    def __init__(self, bridge_maxsize=1000):
+        self.cfg = {'bridge_maxsize': bridge_maxsize}
+        self.out_msgs = asyncio.Queue()
+        self.task_out_msgs = None
+
+    async def consume(self, n):
+        '''get n msgs from out_msgs and mark them as sent'''
+        for _ in range(n):
+            msg = await self.out_msgs.get()
+            future = msg.__dict__.pop('sent_future', None)
+            if future is not None:
+                future.set_result(True)
+
+
+def new_msg(i):
+    '''outbound msg as used with Atelegram.out_msgs'''
+    return Msg({'bot_name': 'mytestbot', 'out_text': f'msg {i}',
+                'message': {'from': {'id': 1}}})
+
+
+async def single_loop(n, futures=False):
+    '''msgs/s of await out_msgs.put() on the event loop
+    futures: attach a delivery future to each msg like Bridge does'''
+    tg = FakeTelegram()
+    tg.task_out_msgs = asyncio.create_task(tg.consume(n))
+    start = time.perf_counter()
+    for i in range(n):
+        msg = new_msg(i)
+        if futures:
+            msg.sent_future = concurrent.futures.Future()
+        await tg.out_msgs.put(msg)
+    await tg.task_out_msgs
+    return n / (time.perf_counter() - start)
+
+
+async def threads_submit(n, batchsize=1, future=True):
+    '''msgs/s of Bridge.submit() (batchsize 1) or Bridge.submit_many()
+    from N_THREADS threads, future=False: fire-and-forget'''
+    tg = FakeTelegram()
+    bridge = Bridge(tg)
+    futures = list()
+    per_thread = n // N_THREADS
+
+    def produce():
+        if batchsize == 1:
+            for i in range(per_thread):
+                futures.append(bridge.submit(new_msg(i), future=future))
+            return
+        for i in range(0, per_thread, batchsize):
+            msgs = [new_msg(j) for j in
+                    range(i, min(i + batchsize, per_thread))]
+            futures.extend(bridge.submit_many(msgs, futures=future))
+
+    tg.task_out_msgs = asyncio.create_task(
+        tg.consume(per_thread * N_THREADS))
+    start = time.perf_counter()
+    threads = [threading.Thread(target=produce) for _ in range(N_THREADS)]
+    for thread in threads:
+        thread.start()
+    await tg.task_out_msgs
+    rate = per_thread * N_THREADS / (time.perf_counter() - start)
+    for thread in threads:
+        thread.join()
+    if future:
+        assert all(f.result() for f in futures), 'future not sent'
+    assert bridge._unsent == 0, 'slots not released'
+    return rate
+
+
+def worker(channel, n):
+    '''worker process pushing n msgs into channel, waits for results'''
+    for i in range(n):
+        channel.put(new_msg(i), tag=i)
+    results = [channel.get_result(timeout=10) for _ in range(n)]
+    tags = {tag for tag, ok, error in results if ok}
+    sys.exit(0 if tags == set(range(n)) else 1)
+
+
+async def process_round_trip(n):
+    '''msgs/s from worker process through ProcessChannel'''
+    tg = FakeTelegram()
+    bridge = Bridge(tg)
+    channel = ProcessChannel(maxsize=100, results=True)
+    tg.task_out_msgs = asyncio.create_task(tg.consume(n))
+    start = time.perf_counter()
+    process = multiprocessing.Process(target=worker, args=(channel, n))
+    process.start()
+    reader = bridge.attach(channel)
+    await tg.task_out_msgs
+    rate = n / (time.perf_counter() - start)
+    process.join()
+    assert process.exitcode == 0, 'worker did not get all results'
+    channel.close()
+    reader.join(timeout=5)
+    assert not reader.is_alive(), 'reader thread not stopped'
+    return rate
+
+
+async def main(n):
+    '''run all checks and print msgs/s'''
+    plain = await single_loop(n)
+    single = await single_loop(n, futures=True)
+    rates = [
+        ('submit(future=False)', await threads_submit(n, future=False)),
+        ('submit_many(futures=False)',
+         await threads_submit(n, batchsize=100, future=False)),
+        ('submit()', await threads_submit(n)),
+        ('submit_many()', await threads_submit(n, batchsize=100))]
+    process = await process_round_trip(n // 10)
+    print(f'single loop put                      : {plain:8.0f} msgs/s')
+    print(f'single loop put + future             : {single:8.0f} msgs/s')
+    for name, rate in rates:
+        print(f'{N_THREADS} threads {name:27}: {rate:8.0f} msgs/s' +
+              f'  ({rate / plain:.0%} of single loop put)')
+    print(f'ProcessChannel with results          : {process:8.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 80000))